@@ -6,6 +6,7 @@ vLLM Benchmark CLI — stress-test an OpenAI-compatible server with parallel req
 import argparse
 import asyncio
 import json
+import math
 import random
 import sys
 import time
@@ -23,6 +24,22 @@ try:
 except ImportError:
     HAS_PSUTIL = False
 
+try:
+    import uvloop
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 # ---------------------------------------------------------------------------
 # Prompt pools (grouped by approximate output size)
 # ---------------------------------------------------------------------------
@@ -72,14 +89,14 @@ LARGE_PROMPTS = [
 
 def pick_prompts(n: int, size: str) -> list[str]:
     pool = {"small": SMALL_PROMPTS, "medium": MEDIUM_PROMPTS, "large": LARGE_PROMPTS}[size]
-    return [random.choice(pool) for _ in range(n)]
+    return random.choices(pool, k=n)
 
 
 # ---------------------------------------------------------------------------
 # Result collection
 # ---------------------------------------------------------------------------
 
-@dataclass
+@dataclass(slots=True)
 class RequestResult:
     prompt: str = ""
     status: str = "ok"
@@ -91,87 +108,234 @@ class RequestResult:
     error: str = ""
 
 
+@dataclass(slots=True)
+class RunStats:
+    """Running aggregates over finished requests, in constant memory.
+
+    Per-request tok/s values are kept in a reservoir sample for the median
+    and P5, which stay exact until more than ``reservoir_size`` requests
+    succeed.
+    """
+    reservoir_size: int = 10_000
+    ok: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    tps_sum: float = 0.0
+    tps_min: float = math.inf
+    tps_max: float = 0.0
+    ttft_sum: float = 0.0
+    ttft_count: int = 0
+    tps_sample: list[float] = field(default_factory=list)
+
+    def add(self, r: RequestResult):
+        if r.status != "ok":
+            self.errors += 1
+            return
+        self.ok += 1
+        self.prompt_tokens += r.prompt_tokens
+        self.completion_tokens += r.completion_tokens
+        tps = r.tokens_per_sec
+        self.tps_sum += tps
+        if tps < self.tps_min:
+            self.tps_min = tps
+        if tps > self.tps_max:
+            self.tps_max = tps
+        if r.ttft_ms:
+            self.ttft_sum += r.ttft_ms
+            self.ttft_count += 1
+        # reservoir sampling (Algorithm R)
+        if len(self.tps_sample) < self.reservoir_size:
+            self.tps_sample.append(tps)
+        else:
+            j = random.randrange(self.ok)
+            if j < self.reservoir_size:
+                self.tps_sample[j] = tps
+
+
 # ---------------------------------------------------------------------------
 # Worker
 # ---------------------------------------------------------------------------
 
-async def send_request(
-    session: aiohttp.ClientSession,
-    url: str,
+_PROMPT_SENTINEL = "\x00prompt\x00"
+
+# SSE framing, matched on raw bytes
+_DATA_PREFIX = b"data:"
+_DATA_LEN = len(_DATA_PREFIX)
+_DONE_MARKER = b"[DONE]"
+_CONTENT_KEY = b'"content":"'
+_CONTENT_KEY_LEN = len(_CONTENT_KEY)
+
+
+def build_body_template(
     model: str,
-    prompt: str,
     max_tokens: int,
     temperature: float,
     stream: bool,
-) -> RequestResult:
-    result = RequestResult(prompt=prompt)
-    body = {
+) -> tuple[bytes, bytes]:
+    """Serialize the request body once, split around the prompt slot.
+
+    Splice a prompt in with ``prefix + json_dumps(prompt) + suffix``.
+    """
+    body = json_dumps({
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": [{"role": "user", "content": _PROMPT_SENTINEL}],
         "max_tokens": max_tokens,
         "temperature": temperature,
         "stream": stream,
-    }
+    })
+    prefix, suffix = body.split(json_dumps(_PROMPT_SENTINEL))
+    return prefix, suffix
+
+
+def scan_content_len(payload: bytes | bytearray) -> int | None:
+    """Character length of the delta ``content`` string in a raw SSE chunk.
+
+    Lifts the string straight out of the bytes instead of parsing the whole
+    chunk. Returns None when the chunk has no string ``content`` (or is not
+    in the compact form OpenAI-compatible servers emit), so the caller can
+    fall back to a full JSON parse.
+    """
+    i = payload.find(_CONTENT_KEY)
+    if i == -1:
+        return None
+    i += _CONTENT_KEY_LEN
+    # find the closing quote, skipping quotes escaped by an odd run of backslashes
+    j = payload.find(b'"', i)
+    while j != -1:
+        k = j
+        while payload[k - 1] == 0x5C:  # backslash
+            k -= 1
+        if (j - k) % 2 == 0:
+            break
+        j = payload.find(b'"', j + 1)
+    if j == -1:
+        return None
+    raw = payload[i:j]
+    if raw.isascii() and b"\\" not in raw:
+        return len(raw)
+    try:
+        return len(json_loads(b'"' + raw + b'"'))
+    except json.JSONDecodeError:
+        return None
+
+
+def drain_sse_lines(
+    buf: bytearray,
+    last_payload: bytes | bytearray | None,
+) -> tuple[int, bytes | bytearray | None, bool]:
+    """Consume every complete line in *buf*.
+
+    Lines are found with a cursor and the buffer is trimmed once at the end,
+    leaving any partial line for the next chunk. Returns the number of
+    content characters seen, the last data payload, and whether ``[DONE]``
+    was reached.
+    """
+    n_chars = 0
+    start = 0
+    while (end := buf.find(b"\n", start)) != -1:
+        line_start, start = start, end + 1
+        # stay on bytes: only the JSON payload is ever decoded
+        if not buf.startswith(_DATA_PREFIX, line_start, end):
+            continue
+        payload = buf[line_start + _DATA_LEN:end].strip()
+        if payload == _DONE_MARKER:
+            return n_chars, last_payload, True
+        last_payload = payload
+        # fast path: no JSON parse for ordinary token chunks
+        chars = scan_content_len(payload)
+        if chars is None:
+            try:
+                chunk_data = json_loads(payload)
+            except json.JSONDecodeError:
+                continue
+            choices = chunk_data.get("choices") or [{}]
+            delta = choices[0].get("delta") or {}
+            chars = len(delta.get("content") or "")
+        n_chars += chars
+    del buf[:start]
+    return n_chars, last_payload, False
+
 
+async def send_request(
+    session: aiohttp.ClientSession,
+    url: str,
+    prompt: str,
+    body: bytes,
+    stream: bool,
+) -> RequestResult:
+    result = RequestResult(prompt=prompt)
     t0 = time.perf_counter()
     first_token_time = None
 
     try:
-        async with session.post(url, json=body) as resp:
+        async with session.post(url, data=body) as resp:
             if resp.status != 200:
                 result.status = "error"
                 result.error = f"HTTP {resp.status}: {await resp.text()}"
-                result.total_time_s = time.perf_counter() - t0
                 return result
 
             if stream:
-                completion_text = ""
-                last_chunk = None
-                async for raw_line in resp.content:
-                    line = raw_line.decode("utf-8", errors="replace").strip()
-                    if not line.startswith("data:"):
-                        continue
-                    payload = line[len("data:"):].strip()
-                    if payload == "[DONE]":
+                completion_chars = 0
+                last_payload = None
+                chunks = resp.content.iter_any()
+                buf = bytearray()
+                # phase 1: read until the first token to stamp TTFT
+                done = False
+                async for chunk in chunks:
+                    buf += chunk
+                    n_chars, last_payload, done = drain_sse_lines(buf, last_payload)
+                    if n_chars:
+                        first_token_time = time.perf_counter()
+                        completion_chars += n_chars
                         break
-                    try:
-                        last_chunk = json.loads(payload)
-                    except json.JSONDecodeError:
-                        continue
-                    delta = last_chunk.get("choices", [{}])[0].get("delta", {})
-                    token_text = delta.get("content") or ""
-                    if token_text and first_token_time is None:
+                    if done:
+                        break
+                # phase 2: same iterator, no TTFT check left in the loop
+                if not done:
+                    async for chunk in chunks:
+                        buf += chunk
+                        n_chars, last_payload, done = drain_sse_lines(buf, last_payload)
+                        completion_chars += n_chars
+                        if done:
+                            break
+                # the stream may end on a data: line with no newline
+                if not done and buf:
+                    buf += b"\n"
+                    n_chars, last_payload, done = drain_sse_lines(buf, last_payload)
+                    if n_chars and first_token_time is None:
                         first_token_time = time.perf_counter()
-                    completion_text += token_text
+                    completion_chars += n_chars
 
-                result.total_time_s = time.perf_counter() - t0
                 # rough token count (chars / 4 fallback)
-                result.completion_tokens = max(1, len(completion_text) // 4)
+                result.completion_tokens = max(1, completion_chars // 4)
                 if first_token_time is not None:
                     result.ttft_ms = (first_token_time - t0) * 1000
 
-                # try to get usage from last chunk
-                if last_chunk:
-                    usage = last_chunk.get("usage") or {}
+                # try to get usage from last chunk, the only one fully parsed
+                if last_payload:
+                    try:
+                        usage = json_loads(last_payload).get("usage") or {}
+                    except json.JSONDecodeError:
+                        usage = {}
                     if usage.get("completion_tokens"):
                         result.completion_tokens = usage["completion_tokens"]
                     if usage.get("prompt_tokens"):
                         result.prompt_tokens = usage["prompt_tokens"]
             else:
-                data = await resp.json()
-                result.total_time_s = time.perf_counter() - t0
+                data = json_loads(await resp.read())
                 usage = data.get("usage", {})
                 result.prompt_tokens = usage.get("prompt_tokens", 0)
                 result.completion_tokens = usage.get("completion_tokens", 0)
 
-            if result.completion_tokens and result.total_time_s > 0:
-                result.tokens_per_sec = result.completion_tokens / result.total_time_s
-
     except Exception as e:
         result.status = "error"
         result.error = str(e)
+    finally:
         result.total_time_s = time.perf_counter() - t0
 
+    if result.completion_tokens and result.total_time_s > 0:
+        result.tokens_per_sec = result.completion_tokens / result.total_time_s
     return result
 
 
@@ -180,13 +344,22 @@ async def send_request(
 # ---------------------------------------------------------------------------
 
 class RamMonitor:
-    """Samples system RAM usage in a background thread."""
+    """Samples system RAM usage in a background thread.
+
+    Only running aggregates are kept, so memory stays constant however long
+    the run lasts.
+    """
 
     def __init__(self, interval: float = 0.5):
         self.interval = interval
-        self.samples: list[float] = []  # used GB
         self._stop = False
         self._total_gb: float = 0.0
+        # running stats over used GB
+        self._count = 0
+        self._first = 0.0
+        self._last = 0.0
+        self._max = 0.0
+        self._sum = 0.0
 
     def start(self):
         if not HAS_PSUTIL:
@@ -202,19 +375,25 @@ class RamMonitor:
 
     def _run(self):
         while not self._stop:
-            mem = psutil.virtual_memory()
-            self.samples.append(mem.used / (1024 ** 3))
+            used = psutil.virtual_memory().used / (1024 ** 3)
+            if not self._count:
+                self._first = used
+            self._last = used
+            if used > self._max:
+                self._max = used
+            self._sum += used
+            self._count += 1
             time.sleep(self.interval)
 
     def summary(self) -> dict:
-        if not self.samples:
+        if not self._count:
             return {}
         return {
             "total_gb": self._total_gb,
-            "start_gb": self.samples[0],
-            "peak_gb": max(self.samples),
-            "avg_gb": sum(self.samples) / len(self.samples),
-            "end_gb": self.samples[-1],
+            "start_gb": self._first,
+            "peak_gb": self._max,
+            "avg_gb": self._sum / self._count,
+            "end_gb": self._last,
         }
 
 
@@ -222,84 +401,149 @@ class RamMonitor:
 # Runner
 # ---------------------------------------------------------------------------
 
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
 async def run_bench(args: argparse.Namespace):
     prompts = pick_prompts(args.requests, args.prompt_size)
     url = f"{args.base_url.rstrip('/')}/v1/chat/completions"
 
-    headers = {"Content-Type": "application/json"}
+    # ask for identity encoding to spare the server compressing the stream;
+    # auto-decompression stays on for servers or proxies that compress anyway
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "identity"}
     if args.api_key:
         headers["Authorization"] = f"Bearer {args.api_key}"
 
-    sem = asyncio.Semaphore(args.parallel)
+    prefix, suffix = build_body_template(
+        args.model, args.max_tokens, args.temperature, args.stream,
+    )
 
-    async def bounded(p: str) -> RequestResult:
-        async with sem:
-            return await send_request(
-                session, url, args.model, p,
-                args.max_tokens, args.temperature, args.stream,
+    # prompts come from small fixed pools, so each body is encoded at most once
+    body_cache: dict[str, bytes] = {}
+
+    # a fixed pool of --parallel workers drains the prompt queue, so only
+    # O(parallel) coroutines are alive regardless of --requests
+    todo: asyncio.Queue[str] = asyncio.Queue()
+    for p in prompts:
+        todo.put_nowait(p)
+
+    # progress lines are written in batches by a background task instead of
+    # one blocking print() per completed request
+    print_q: asyncio.Queue[str | None] = asyncio.Queue()
+
+    stats = RunStats()
+    completed = 0
+
+    async def worker():
+        # each worker records its own results, so nothing sits between a
+        # finished request and the stats/progress update
+        nonlocal completed
+        while not todo.empty():
+            p = todo.get_nowait()
+            body = body_cache.get(p)
+            if body is None:
+                body = body_cache[p] = prefix + json_dumps(p) + suffix
+            r = await send_request(session, url, p, body, args.stream)
+            stats.add(r)
+            completed += 1
+            mark = "OK" if r.status == "ok" else "ERR"
+            tps = f"{r.tokens_per_sec:6.1f} t/s" if r.tokens_per_sec else "  n/a  "
+            ttft = f"{r.ttft_ms:6.0f}ms" if r.ttft_ms else "   n/a "
+            print_q.put_nowait(
+                f"  [{completed:>{len(str(args.requests))}}/{args.requests}] "
+                f"{mark}  {tps}  TTFT {ttft}  "
+                f"({r.completion_tokens:>4} tok in {r.total_time_s:.2f}s)  "
+                f"{'| ' + r.error if r.error else ''}\n"
             )
 
+    async def printer():
+        while True:
+            lines = [await print_q.get()]
+            while not print_q.empty():
+                lines.append(print_q.get_nowait())
+            stop = lines[-1] is None
+            if stop:
+                lines.pop()
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+            if stop:
+                return
+
     print(f"\n{'='*60}")
     print(f" vLLM Bench — {args.requests} requests, {args.parallel} parallel")
     print(f" Server : {url}")
     print(f" Model  : {args.model}")
     print(f" Max tok: {args.max_tokens}  |  Prompt size: {args.prompt_size}")
     print(f" Stream : {args.stream}")
+    print(f" Warmup : {args.warmup}")
     print(f"{'='*60}\n")
 
     ram = RamMonitor()
     ram.start()
 
-    results: list[RequestResult] = []
-    t_start = time.perf_counter()
-
     timeout = aiohttp.ClientTimeout(total=args.timeout)
-    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-        tasks = [asyncio.create_task(bounded(p)) for p in prompts]
-        for i, coro in enumerate(asyncio.as_completed(tasks), 1):
-            r = await coro
-            results.append(r)
-            mark = "OK" if r.status == "ok" else "ERR"
-            tps = f"{r.tokens_per_sec:6.1f} t/s" if r.tokens_per_sec else "  n/a  "
-            ttft = f"{r.ttft_ms:6.0f}ms" if r.ttft_ms else "   n/a "
-            print(f"  [{i:>{len(str(args.requests))}}/{args.requests}] "
-                  f"{mark}  {tps}  TTFT {ttft}  "
-                  f"({r.completion_tokens:>4} tok in {r.total_time_s:.2f}s)  "
-                  f"{'| ' + r.error if r.error else ''}")
+    # one pooled keep-alive connection per concurrent stream; the default
+    # cap of 100 would silently throttle runs with --parallel > 100
+    connector = aiohttp.TCPConnector(
+        limit=args.parallel,
+        limit_per_host=args.parallel,
+        ttl_dns_cache=600,
+        keepalive_timeout=75,
+    )
+    async with aiohttp.ClientSession(
+        headers=headers, timeout=timeout, connector=connector,
+    ) as session:
+        if args.warmup and prompts:
+            # open a connection and wake the server outside the timed window
+            w_prefix, w_suffix = build_body_template(
+                args.model, 1, args.temperature, False,
+            )
+            r = await send_request(
+                session, url, prompts[0],
+                w_prefix + json_dumps(prompts[0]) + w_suffix, False,
+            )
+            if r.status != "ok":
+                print(f"  Warmup failed: {r.error}\n")
+
+        t_start = time.perf_counter()
+        printer_task = asyncio.create_task(printer())
+        await asyncio.gather(*(worker() for _ in range(args.parallel)))
+        print_q.put_nowait(None)
+        await printer_task
 
     wall = time.perf_counter() - t_start
     ram.stop()
     ram_info = ram.summary()
 
-    ok = [r for r in results if r.status == "ok"]
-    errs = len(results) - len(ok)
-
-    if not ok:
+    if not stats.ok:
         print("\nAll requests failed.")
         return
 
-    total_comp = sum(r.completion_tokens for r in ok)
-    total_prompt = sum(r.prompt_tokens for r in ok)
-    avg_tps = sum(r.tokens_per_sec for r in ok) / len(ok)
+    total_comp = stats.completion_tokens
     aggregate_tps = total_comp / wall if wall else 0
-    avg_ttft = sum(r.ttft_ms for r in ok if r.ttft_ms) / max(1, sum(1 for r in ok if r.ttft_ms))
-    p50 = sorted(r.tokens_per_sec for r in ok)[len(ok) // 2]
-    fastest = max(r.tokens_per_sec for r in ok)
-    slowest = min(r.tokens_per_sec for r in ok)
+    avg_tps = stats.tps_sum / stats.ok
+    tps = sorted(stats.tps_sample)
+    p50 = tps[len(tps) // 2]
+    p5 = percentile(tps, 5)
+    avg_ttft = stats.ttft_sum / stats.ttft_count if stats.ttft_count else 0
 
     print(f"\n{'='*60}")
     print(f" RESULTS")
     print(f"{'='*60}")
     print(f"  Wall time         : {wall:.2f}s")
-    print(f"  Requests          : {len(ok)} ok / {errs} errors")
-    print(f"  Prompt tokens     : {total_prompt}")
+    print(f"  Requests          : {stats.ok} ok / {stats.errors} errors")
+    print(f"  Prompt tokens     : {stats.prompt_tokens}")
     print(f"  Completion tokens : {total_comp}")
     print(f"  ---")
     print(f"  Aggregate tok/s   : {aggregate_tps:.1f}  (total tokens / wall time)")
     print(f"  Avg tok/s per req : {avg_tps:.1f}")
     print(f"  Median tok/s      : {p50:.1f}")
-    print(f"  Fastest           : {fastest:.1f} t/s")
-    print(f"  Slowest           : {slowest:.1f} t/s")
+    print(f"  P5 tok/s          : {p5:.1f}  (slowest 5% of requests)")
+    print(f"  Fastest           : {stats.tps_max:.1f} t/s")
+    print(f"  Slowest           : {stats.tps_min:.1f} t/s")
     if avg_ttft:
         print(f"  Avg TTFT          : {avg_ttft:.0f}ms")
     if ram_info:
@@ -351,8 +595,15 @@ examples:
                    help="Disable streaming (streaming is on by default)")
     p.add_argument("--timeout", type=int, default=120,
                    help="Per-request timeout in seconds (default: 120)")
+    p.add_argument("--no-warmup", dest="warmup", action="store_false",
+                   help="Skip the untimed warmup request (warmup is on by default)")
     args = p.parse_args()
-    asyncio.run(run_bench(args))
+    if HAS_UVLOOP and hasattr(uvloop, "run"):
+        uvloop.run(run_bench(args))
+    else:
+        if HAS_UVLOOP:
+            uvloop.install()  # uvloop < 0.18 has no run()
+        asyncio.run(run_bench(args))
 
 
 if __name__ == "__main__":